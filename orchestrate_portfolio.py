@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
-import os, sys, subprocess, json, time, mimetypes, argparse
+import os, sys, subprocess, json, time, mimetypes, argparse, threading, hashlib, mmap, random, gzip, io, functools, zlib, base64, collections
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
 try:
@@ -8,6 +10,8 @@ except ImportError:
     load_dotenv = None
 try:
     import boto3
+    from boto3.s3.transfer import TransferConfig, create_transfer_manager
+    from botocore.config import Config
     from botocore.exceptions import ClientError
 except ImportError:
     boto3 = None
@@ -15,12 +19,52 @@ try:
     import requests
 except ImportError:
     requests = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 def log(msg): print(msg, flush=True)
 
+DEFAULT_UPLOAD_WORKERS = 32
+MAX_INFLIGHT_INVALIDATIONS = 3
+_IMMUTABLE_EXT = frozenset({".js",".css",".png",".jpg",".jpeg",".webp",".svg",".ico",".json",".woff",".woff2"})
+_NEXT_RE = "/_next/"
+_GZIP_TYPES = frozenset({"application/javascript","application/json","image/svg+xml"})
+GZIP_MIN_SIZE = 1024
+MMAP_MIN_SIZE = 16 * 1024
+MB = 1024 * 1024
+VERIFY_MAX_BYTES = 64 * 1024
+# pinned rather than CRC32C-when-CRT-is-installed: machines with and without the
+# CRT would otherwise alternate algorithms and never match each other's checksums
+CHECKSUM_ALGORITHM = "CRC32"
+
+mimetypes.init()
+
+def dumps_bytes(obj):
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        except orjson.JSONEncodeError:
+            pass  # e.g. ints beyond 64 bits, which stdlib json handles
+    return json.dumps(obj, indent=2).encode()
+
+def dumps(obj):
+    return dumps_bytes(obj).decode()
+
+def write_json(path, obj):
+    Path(path).write_bytes(dumps_bytes(obj))
+
 def run(cmd, cwd=None, check=True):
     log("$ " + " ".join(cmd))
-    return subprocess.run(cmd, cwd=cwd, check=check)
+    with subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          bufsize=1, text=True, encoding="utf-8", errors="replace") as p:
+        for line in p.stdout:
+            sys.stdout.write(line)
+        sys.stdout.flush()
+    if check and p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return subprocess.CompletedProcess(cmd, p.returncode)
 
 def require(tool, where=None):
     try:
@@ -28,54 +72,130 @@ def require(tool, where=None):
     except Exception as e:
         sys.exit(f"Missing {tool}. Install it. Error: {e}")
 
+@dataclass(frozen=True, slots=True)
+class Env:
+    nextjs_dir: Path | None
+    forecast_base: str
+    monte_base: str
+    portfolio_base: str
+    public_api: str
+    aws_region: str
+    s3_bucket: str
+    s3_prefix: str
+    cloudfront_distribution_id: str
+    cloudfront_invalidate_paths: tuple
+    aws_access_key_id: str | None
+    aws_secret_access_key: str | None
+    dry_run: bool
+    skip_npm_ci: bool
+    s3_accelerate: bool
+    upload_workers: int
+    force_upload: bool
+
 def load_env():
     if load_dotenv:
         load_dotenv(override=False)
-    env = {k: os.getenv(k, "") for k in [
-        "NEXTJS_DIR",
-        "FORECAST_API_BASE","MONTE_API_BASE","PORTFOLIO_API_BASE",
-        "NEXT_PUBLIC_PORTFOLIO_API",
-        "AWS_REGION","S3_BUCKET","S3_PREFIX","CLOUDFRONT_DISTRIBUTION_ID",
-        "AWS_ACCESS_KEY_ID","AWS_SECRET_ACCESS_KEY",
-        "DRY_RUN","SKIP_NPM_CI"
-    ]}
-    return env
-
-def http_get_json(url, timeout=8):
+    get = lambda k: os.getenv(k, "")
+    flag = lambda k: get(k).lower() == "true"
+    nd = get("NEXTJS_DIR")
+    paths = [x.strip() for x in get("CLOUDFRONT_INVALIDATE_PATHS").split(",") if x.strip()]
+    try:
+        workers = int(get("S3_UPLOAD_WORKERS") or DEFAULT_UPLOAD_WORKERS)
+    except ValueError:
+        sys.exit("S3_UPLOAD_WORKERS must be an integer")
+    if workers < 1:
+        log(f"WARN: S3_UPLOAD_WORKERS={workers} is below 1; using 1")
+        workers = 1
+    return Env(
+        nextjs_dir=Path(nd).expanduser() if nd else None,
+        forecast_base=get("FORECAST_API_BASE").rstrip("/"),
+        monte_base=get("MONTE_API_BASE").rstrip("/"),
+        portfolio_base=get("PORTFOLIO_API_BASE").rstrip("/"),
+        public_api=get("NEXT_PUBLIC_PORTFOLIO_API"),
+        aws_region=get("AWS_REGION") or "us-east-1",
+        s3_bucket=get("S3_BUCKET"),
+        s3_prefix=get("S3_PREFIX").strip("/"),
+        cloudfront_distribution_id=get("CLOUDFRONT_DISTRIBUTION_ID"),
+        cloudfront_invalidate_paths=tuple(paths or ["/*"]),
+        aws_access_key_id=get("AWS_ACCESS_KEY_ID") or None,
+        aws_secret_access_key=get("AWS_SECRET_ACCESS_KEY") or None,
+        dry_run=flag("DRY_RUN"),
+        skip_npm_ci=flag("SKIP_NPM_CI"),
+        s3_accelerate=flag("S3_ACCELERATE"),
+        upload_workers=workers,
+        force_upload=flag("FORCE_UPLOAD"),
+    )
+
+def retryable(e):
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code >= 500 or e.response.status_code == 429)
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+class TruncatedBody(str):
+    """Raw text prefix of a JSON body that exceeded max_bytes; not parsed."""
+
+def http_get_json(url, timeout=8, attempts=5, max_wait=30, max_bytes=None):
+    # with max_bytes, an oversized body is cut off and returned as a TruncatedBody,
+    # provided it at least starts like JSON; anything else is an error regardless of size
     if not requests:
         raise SystemExit("requests not installed: python3 -m pip install requests")
-    r = requests.get(url, timeout=timeout)
-    r.raise_for_status()
-    return r.json()
+    # max_wait bounds the whole check: request time plus backoff sleeps
+    deadline = time.monotonic() + max_wait
+    for attempt in range(attempts):
+        try:
+            budget = min(timeout, deadline - time.monotonic())
+            with requests.get(url, timeout=budget, stream=max_bytes is not None) as r:
+                r.raise_for_status()
+                if max_bytes is None:
+                    return r.json()
+                raw = bytearray()
+                for chunk in r.iter_content(65536):
+                    raw += chunk
+                    if len(raw) > max_bytes:
+                        head = raw[:max_bytes].decode("utf-8", errors="replace")
+                        if not head.lstrip().startswith(("{", "[")):
+                            raise ValueError(f"non-JSON response from {url}")
+                        return TruncatedBody(head)
+            return json.loads(raw) if raw else {}
+        except requests.RequestException as e:
+            remaining = deadline - time.monotonic()
+            delay = (2 ** attempt) * 0.5 + random.random() * 0.5
+            # no point sleeping if nothing is left for another attempt afterwards
+            if not retryable(e) or attempt == attempts - 1 or delay >= remaining:
+                raise
+            time.sleep(delay)
 
 def verify_services(env):
-    ok = True
-    checks = []
-    def add(name, url):
-        nonlocal ok
+    def probe(url):
         try:
-            data = http_get_json(url)
-            checks.append((name, True, data))
+            return True, http_get_json(url, max_bytes=VERIFY_MAX_BYTES)
         except Exception as e:
-            checks.append((name, False, str(e)))
-            ok = False
+            return False, str(e)
 
-    fb = env["FORECAST_API_BASE"].rstrip("/") if env["FORECAST_API_BASE"] else ""
-    mb = env["MONTE_API_BASE"].rstrip("/") if env["MONTE_API_BASE"] else ""
-    pb = env["PORTFOLIO_API_BASE"].rstrip("/") if env["PORTFOLIO_API_BASE"] else ""
+    fb, mb, pb = env.forecast_base, env.monte_base, env.portfolio_base
 
-    if fb: add("forecast health", f"{fb}/health")
-    if fb: add("forecast status", f"{fb}/public/status")
-    if mb: add("monte health",    f"{mb}/health")
-    if mb: add("monte status",    f"{mb}/public/status")
-    if pb: add("portfolio tiles", f"{pb}/tiles")
-    if pb: add("portfolio status",f"{pb}/status")
+    urls = []
+    if fb: urls.append(("forecast health", f"{fb}/health"))
+    if fb: urls.append(("forecast status", f"{fb}/public/status"))
+    if mb: urls.append(("monte health",    f"{mb}/health"))
+    if mb: urls.append(("monte status",    f"{mb}/public/status"))
+    if pb: urls.append(("portfolio tiles", f"{pb}/tiles"))
+    if pb: urls.append(("portfolio status",f"{pb}/status"))
+
+    checks = []
+    if urls:
+        with ThreadPoolExecutor(max_workers=len(urls)) as ex:
+            results = list(ex.map(probe, [u for _, u in urls]))
+        checks = [(name, passed, data) for (name, _), (passed, data) in zip(urls, results)]
+    ok = all(passed for _, passed, _ in checks)
 
     for name, passed, data in checks:
-        log(f"[{'OK' if passed else 'ERR'}] {name}")
+        truncated = isinstance(data, TruncatedBody)
+        note = f" (truncated at {VERIFY_MAX_BYTES} bytes, not parsed)" if truncated else ""
+        log(f"[{'OK' if passed else 'ERR'}] {name}{note}")
         if passed:
             try:
-                s = json.dumps(data, indent=2)
+                s = data if truncated else dumps(data)
                 log(s if len(s) < 1200 else s[:1200] + "\n...")
             except Exception:
                 log(str(data)[:600])
@@ -87,33 +207,42 @@ def ensure_node(next_dir: Path, skip_npm_ci=False):
     require("node", where=next_dir)
     require("npm", where=next_dir)
     require("npx", where=next_dir)
-    if not skip_npm_ci or not (next_dir / "node_modules").exists():
-        run(["npm", "ci"], cwd=next_dir)
+    modules = next_dir / "node_modules"
+    if skip_npm_ci and modules.exists():
+        return
+    lock = next_dir / "package-lock.json"
+    stamp = modules / ".install-hash"
+    h = hashlib.sha256(lock.read_bytes()).hexdigest() if lock.exists() else ""
+    if h and stamp.exists() and stamp.read_text().strip() == h:
+        log("node_modules matches package-lock.json; skipping npm ci")
+        return
+    run(["npm", "ci", "--prefer-offline", "--no-audit", "--no-fund"], cwd=next_dir)
+    if h: stamp.write_text(h)
 
 def write_build_env(next_dir: Path, public_api: str):
     p = next_dir / ".env.production"
-    content = f"NEXT_PUBLIC_PORTFOLIO_API={public_api}\n"
+    key, line = "NEXT_PUBLIC_PORTFOLIO_API", f"NEXT_PUBLIC_PORTFOLIO_API={public_api}"
+    lines, seen = [], False
     if p.exists():
-        txt = p.read_text()
-        if "NEXT_PUBLIC_PORTFOLIO_API=" in txt:
-            lines = [l for l in txt.splitlines() if not l.startswith("NEXT_PUBLIC_PORTFOLIO_API=")]
-            lines.append(content.strip())
-            p.write_text("\n".join(lines) + "\n")
-        else:
-            p.write_text(txt + ("\n" if not txt.endswith("\n") else "") + content)
-    else:
-        p.write_text(content)
+        for l in p.read_text().splitlines():
+            if l.partition("=")[0].strip() == key:
+                if seen: continue
+                l, seen = line, True
+            lines.append(l)
+    if not seen: lines.append(line)
+    tmp = p.with_suffix(".production.tmp")
+    tmp.write_text("\n".join(lines) + "\n")
+    os.replace(tmp, p)
     log(f"wrote {p}")
 
 def build_static(env):
-    nd = env["NEXTJS_DIR"]
-    if not nd: sys.exit("NEXTJS_DIR missing in .env")
-    next_dir = Path(nd).expanduser()
+    next_dir = env.nextjs_dir
+    if not next_dir: sys.exit("NEXTJS_DIR missing in .env")
     if not next_dir.exists(): sys.exit(f"NEXTJS_DIR not found: {next_dir}")
-    public_api = env["NEXT_PUBLIC_PORTFOLIO_API"] or env["PORTFOLIO_API_BASE"]
+    public_api = env.public_api or env.portfolio_base
     if not public_api:
         log("WARN: NEXT_PUBLIC_PORTFOLIO_API is empty; your site may not know where to fetch tiles.")
-    ensure_node(next_dir, env.get("SKIP_NPM_CI","").lower()=="true")
+    ensure_node(next_dir, env.skip_npm_ci)
     if public_api: write_build_env(next_dir, public_api)
     run(["npm","run","build"], cwd=next_dir)
     out = next_dir / "out"
@@ -121,31 +250,157 @@ def build_static(env):
     log(f"ok: built {out}")
     return out
 
-def guess_headers(path: Path):
-    ctype, _ = mimetypes.guess_type(str(path))
-    if not ctype: ctype = "application/octet-stream"
-    rel = path.as_posix()
-    if rel.endswith(".html"):
+@functools.lru_cache(maxsize=128)
+def _ctype_for_ext(ext):
+    return mimetypes.types_map.get(ext) or mimetypes.guess_type("x" + ext)[0] or "application/octet-stream"
+
+def guess_headers(path):
+    rel = os.fspath(path).replace(os.sep, "/")
+    ext = os.path.splitext(rel)[1].lower()
+    ctype = _ctype_for_ext(ext)
+    if ext == ".html":
         cache = "public, max-age=0, must-revalidate"
-    elif ("/_next/" in rel) or any(rel.endswith(ext) for ext in [".js",".css",".png",".jpg",".jpeg",".webp",".svg",".ico",".json",".woff",".woff2"]):
+    elif _NEXT_RE in rel or ext in _IMMUTABLE_EXT:
         cache = "public, max-age=31536000, immutable"
     else:
         cache = "public, max-age=300"
     return ctype, cache
 
-def s3_upload_dir(env, out_dir: Path):
+_s3_clients = {}
+_s3_lock = threading.Lock()
+
+def get_s3_client(env, accelerate=False):
+    # boto3 clients are thread-safe: build one and share it across upload workers
+    with _s3_lock:
+        if accelerate not in _s3_clients:
+            if not boto3:
+                raise SystemExit("boto3 not installed: python3 -m pip install boto3")
+            _s3_clients[accelerate] = boto3.client(
+                "s3",
+                aws_access_key_id=env.aws_access_key_id,
+                aws_secret_access_key=env.aws_secret_access_key,
+                region_name=env.aws_region,
+                config=Config(max_pool_connections=max(64, 2 * env.upload_workers),
+                              retries={"mode": "adaptive", "max_attempts": 10},
+                              tcp_keepalive=True,
+                              s3={"addressing_style": "virtual",
+                                  "use_accelerate_endpoint": accelerate})
+            )
+        return _s3_clients[accelerate]
+
+def s3_enable_acceleration(s3, bucket):
+    # Transfer Acceleration needs DNS-compliant bucket names (no dots)
+    if "." in bucket:
+        log(f"WARN: S3_ACCELERATE ignored; bucket name has dots: {bucket}")
+        return False
+    try:
+        s3.put_bucket_accelerate_configuration(
+            Bucket=bucket, AccelerateConfiguration={"Status": "Enabled"})
+    except ClientError as e:
+        log(f"WARN: could not enable S3 Transfer Acceleration: {e}")
+        return False
+    log(f"S3 Transfer Acceleration enabled: s3://{bucket}")
+    return True
+
+def walk_files(root):
+    stack = [os.fspath(root)]
+    while stack:
+        d = stack.pop()
+        with os.scandir(d) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.is_file(follow_symlinks=False):
+                    yield e
+
+def interleave_by_prefix(root, depth=2):
+    # S3 scales request rate per key prefix; round-robin across the first `depth`
+    # directories so concurrent PUTs spread over partitions instead of one prefix.
+    # Only the top `depth` levels are scanned up front; each deeper subtree is a
+    # lazy walk_files generator, so uploads start before the whole tree is read.
+    streams = []
+    def scan(d, level):
+        files = []
+        with os.scandir(d) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if level + 1 < depth: scan(e.path, level + 1)
+                    else: streams.append(walk_files(e.path))
+                elif e.is_file(follow_symlinks=False):
+                    files.append(e)
+        if files: streams.append(iter(files))
+    scan(root, 0)
+    queue = collections.deque(streams)
+    while queue:
+        it = queue.popleft()
+        e = next(it, None)
+        if e is None: continue
+        queue.append(it)
+        yield e, e.path[len(root):].replace(os.sep, "/")
+
+def should_gzip(ctype, size):
+    return size > GZIP_MIN_SIZE and (ctype.startswith("text/") or ctype in _GZIP_TYPES)
+
+def with_file_bytes(path, fn):
+    # mmap avoids a whole-file bytes copy; below a few pages plain read() is cheaper
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+            return fn(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return fn(mm)
+
+def gzip_file(path):
+    # mtime=0 keeps the output byte-stable so the ETag skip still matches on redeploy
+    return with_file_bytes(path, lambda b: gzip.compress(b, compresslevel=6, mtime=0))
+
+def file_md5(path):
+    return with_file_bytes(path, lambda b: hashlib.md5(b).hexdigest())
+
+def checksum_b64(data):
+    return base64.b64encode(zlib.crc32(data).to_bytes(4, "big")).decode()
+
+def file_checksum(path):
+    return with_file_bytes(path, checksum_b64)
+
+def s3_stored_checksum(s3, bucket, key):
+    # the manifest may be minutes old (prewarmed before the build); a missing or
+    # unreadable object just counts as changed
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED")
+    except ClientError:
+        return None
+    return head.get(f"Checksum{CHECKSUM_ALGORITHM}")
+
+def s3_list_etags(s3, bucket, prefix):
+    etags = {}
+    pages = s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix)
+    for page in pages:
+        for obj in page.get("Contents", []):
+            etags[obj["Key"]] = obj["ETag"].strip('"')
+    return etags
+
+def prewarm_s3(env):
+    # build the S3 client and list existing keys in the background while the build runs
+    result = {}
+    bucket = env.s3_bucket
+    if not boto3 or not bucket or env.dry_run or env.force_upload:
+        return None, result
+    def work():
+        try:
+            s3 = get_s3_client(env)
+            result["etags"] = s3_list_etags(s3, bucket, env.s3_prefix)
+        except Exception as e:
+            log(f"WARN: S3 prewarm failed: {e}")
+    t = threading.Thread(target=work, daemon=True)
+    t.start()
+    return t, result
+
+def s3_upload_dir(env, out_dir: Path, existing=None):
     if not boto3:
         raise SystemExit("boto3 not installed: python3 -m pip install boto3")
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=env["AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=env["AWS_SECRET_ACCESS_KEY"],
-        region_name=env["AWS_REGION"] or "us-east-1"
-    )
-    bucket = env["S3_BUCKET"]
-    prefix = (env["S3_PREFIX"] or "").strip("/")
+    s3 = get_s3_client(env)
+    bucket, prefix, dry = env.s3_bucket, env.s3_prefix, env.dry_run
     if not bucket: sys.exit("S3_BUCKET missing in .env")
-    dry = env.get("DRY_RUN","").lower()=="true"
 
     try:
         s3.head_bucket(Bucket=bucket)
@@ -153,29 +408,105 @@ def s3_upload_dir(env, out_dir: Path):
     except ClientError:
         log(f"creating bucket: {bucket}")
         params = {"Bucket": bucket}
-        if (env["AWS_REGION"] or "us-east-1") != "us-east-1":
-            params["CreateBucketConfiguration"] = {"LocationConstraint": env["AWS_REGION"]}
+        if env.aws_region != "us-east-1":
+            params["CreateBucketConfiguration"] = {"LocationConstraint": env.aws_region}
         if not dry:
             s3.create_bucket(**params)
 
-    uploaded = 0
-    for p in out_dir.rglob("*"):
-        if not p.is_file(): continue
-        rel = p.relative_to(out_dir).as_posix()
-        key = f"{prefix}/{rel}" if prefix else rel
-        ctype, cache = guess_headers(p)
-        if dry:
-            log(f"[DRY] PUT s3://{bucket}/{key} ({ctype}, {cache})")
-            continue
-        with p.open("rb") as f:
-            s3.put_object(Bucket=bucket, Key=key, Body=f.read(),
-                          ContentType=ctype, CacheControl=cache)
-        uploaded += 1
-        if uploaded % 50 == 0: log(f"uploaded {uploaded} files...")
-    log(f"uploaded total: {uploaded}")
+    if env.s3_accelerate and not dry:
+        if s3_enable_acceleration(s3, bucket):
+            s3 = get_s3_client(env, accelerate=True)
+
+    root = os.path.join(os.fspath(out_dir), "")
+    def files():
+        for e, rel in interleave_by_prefix(root):
+            key = f"{prefix}/{rel}" if prefix else rel
+            ctype, cache = guess_headers(e.path)
+            yield e.path, e.stat().st_size, key, ctype, cache
+
+    if dry:
+        for p, size, key, ctype, cache in files():
+            gz = ", gzip" if should_gzip(ctype, size) else ""
+            log(f"[DRY] PUT s3://{bucket}/{key} ({ctype}, {cache}{gz})")
+        log("uploaded=0 skipped=0")
+        return None
+
+    # the skip compares content only; FORCE_UPLOAD re-applies changed headers
+    # (Content-Type, Cache-Control, Content-Encoding) to byte-identical objects
+    if env.force_upload:
+        existing = {}
+    elif existing is None:
+        existing = s3_list_etags(s3, bucket, prefix)
+    # the shared manager's executors cap in-flight requests for the whole tree, so
+    # size them to the worker pool rather than the per-file default of 10
+    transfer = TransferConfig(multipart_threshold=8*MB, multipart_chunksize=8*MB,
+                              max_concurrency=max(10, env.upload_workers),
+                              use_threads=True)
+    transfer.max_submission_concurrency = env.upload_workers
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(2 * env.upload_workers)
+    uploaded = skipped = 0
+    # first worker error stops further submissions so a bad deploy fails fast
+    failed = threading.Event()
+    errors = []
+    def put(p, size, key, ctype, cache):
+        nonlocal uploaded, skipped
+        try:
+            if failed.is_set(): return
+            extra = {"ContentType": ctype, "CacheControl": cache,
+                     "ChecksumAlgorithm": CHECKSUM_ALGORITHM}
+            body = None
+            if should_gzip(ctype, size):
+                body = gzip_file(p)
+                extra["ContentEncoding"] = "gzip"
+            crc = None
+            etag = existing.get(key)
+            if etag and "-" not in etag:
+                same = etag == (hashlib.md5(body).hexdigest() if body is not None else file_md5(p))
+            elif etag:
+                # multipart ETags are not an MD5; compare the full-object checksum instead
+                crc = checksum_b64(body) if body is not None else file_checksum(p)
+                stored = s3_stored_checksum(s3, bucket, key)
+                same = stored == crc
+            else:
+                same = False
+            if same:
+                with lock: skipped += 1
+                return
+            # sending the value (not just the algorithm) makes S3 store a FULL_OBJECT
+            # checksum on multipart uploads, which the skip check above can match
+            if crc is None:
+                crc = checksum_b64(body) if body is not None else file_checksum(p)
+            extra[f"Checksum{CHECKSUM_ALGORITHM}"] = crc
+            src = io.BytesIO(body) if body is not None else p
+            tm.upload(src, bucket, key, extra_args=extra).result()
+            with lock:
+                uploaded += 1
+                if uploaded % 50 == 0: log(f"uploaded {uploaded} files...")
+        except BaseException as e:
+            with lock: errors.append(e)
+            failed.set()
+        finally:
+            slots.release()
+
+    # one TransferManager for the whole tree; per-call upload_file would build and
+    # tear down its own executors for every file
+    with create_transfer_manager(s3, transfer) as tm, \
+         ThreadPoolExecutor(max_workers=env.upload_workers) as ex:
+        for item in files():
+            slots.acquire()
+            if failed.is_set():
+                slots.release()
+                break
+            ex.submit(put, *item)
+    if errors:
+        log(f"upload failed after uploaded={uploaded} skipped={skipped}; stopped submitting")
+        raise errors[0]
+    log(f"uploaded={uploaded} skipped={skipped}")
+    return uploaded
 
 def cf_invalidate(env):
-    dist = env.get("CLOUDFRONT_DISTRIBUTION_ID","")
+    dist = env.cloudfront_distribution_id
     if not dist:
         log("no CLOUDFRONT_DISTRIBUTION_ID set; skipping invalidate")
         return
@@ -183,29 +514,49 @@ def cf_invalidate(env):
         raise SystemExit("boto3 not installed: python3 -m pip install boto3")
     cf = boto3.client(
         "cloudfront",
-        aws_access_key_id=env["AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=env["AWS_SECRET_ACCESS_KEY"]
+        aws_access_key_id=env.aws_access_key_id,
+        aws_secret_access_key=env.aws_secret_access_key
     )
+    paths = list(env.cloudfront_invalidate_paths)
     caller = str(int(time.time()))
-    if env.get("DRY_RUN","").lower()=="true":
-        log(f"[DRY] CloudFront invalidate {dist} /*")
+    if env.dry_run:
+        log(f"[DRY] CloudFront invalidate {dist} {' '.join(paths)}")
         return
+    cf_wait_for_slot(cf, dist)
     resp = cf.create_invalidation(
         DistributionId=dist,
-        InvalidationBatch={"Paths":{"Quantity":1,"Items":["/*"]},
+        InvalidationBatch={"Paths":{"Quantity":len(paths),"Items":paths},
                            "CallerReference":caller}
     )
     inv_id = resp["Invalidation"]["Id"]
     log(f"created CloudFront invalidation: {inv_id}")
 
+def cf_wait_for_slot(cf, dist, max_wait=600):
+    items = cf.list_invalidations(DistributionId=dist)["InvalidationList"].get("Items", [])
+    inflight = [i["Id"] for i in items if i["Status"] == "InProgress"]
+    if len(inflight) < MAX_INFLIGHT_INVALIDATIONS:
+        return
+    # newest first; the oldest in-flight invalidation is the likeliest to finish
+    inv_id = inflight[-1]
+    delay, waited = 5, 0
+    while waited < max_wait:
+        log(f"{len(inflight)} invalidations in progress; waiting {delay}s on {inv_id}...")
+        time.sleep(delay)
+        waited += delay
+        status = cf.get_invalidation(DistributionId=dist, Id=inv_id)["Invalidation"]["Status"]
+        if status != "InProgress":
+            return
+        delay = min(delay * 2, 60)
+    log(f"WARN: {inv_id} still in progress after {waited}s; creating invalidation anyway")
+
 def fetch_tiles(env):
-    pb = (env["PORTFOLIO_API_BASE"] or "").rstrip("/")
+    pb = env.portfolio_base
     if not pb: sys.exit("PORTFOLIO_API_BASE missing in .env")
     tiles = http_get_json(f"{pb}/tiles")
     status = http_get_json(f"{pb}/status")
     Path("snapshots").mkdir(exist_ok=True)
-    Path("snapshots/tiles.json").write_text(json.dumps(tiles, indent=2))
-    Path("snapshots/status.json").write_text(json.dumps(status, indent=2))
+    write_json("snapshots/tiles.json", tiles)
+    write_json("snapshots/status.json", status)
     log("wrote snapshots/tiles.json and snapshots/status.json")
 
 def sentiment_placeholder_tile():
@@ -220,7 +571,7 @@ def sentiment_placeholder_tile():
         "foot":"",
         "updated_at":None
     }
-    print(json.dumps(tile, indent=2))
+    print(dumps(tile))
 
 def main():
     env = load_env()
@@ -240,8 +591,7 @@ def main():
     elif args.cmd == "build":
         build_static(env)
     elif args.cmd == "deploy":
-        nd = env["NEXTJS_DIR"]
-        out_dir = Path(nd).expanduser() / "out"
+        out_dir = (env.nextjs_dir or Path()) / "out"
         if not out_dir.exists(): sys.exit("No ./out found. Run 'build' first.")
         s3_upload_dir(env, out_dir)
     elif args.cmd == "invalidate":
@@ -249,8 +599,14 @@ def main():
     elif args.cmd == "all":
         ok = verify_services(env)
         if not ok: log("verify had failures; continuing...")
+        warm, prewarmed = prewarm_s3(env)
         out_dir = build_static(env)
-        s3_upload_dir(env, out_dir)
+        if warm: warm.join()
+        uploaded = s3_upload_dir(env, out_dir, existing=prewarmed.get("etags"))
+        if uploaded == 0:
+            log("no changes; skipping CloudFront invalidation "
+                "(if the last invalidation failed, run 'invalidate' manually)")
+            return
         cf_invalidate(env)
     elif args.cmd == "tiles":
         fetch_tiles(env)